@@ -172,8 +172,8 @@ class PrinterCallbacks(object):
 
 class QueuedPrinterCallbacks(PrinterCallbacks):
     """
-    Printer callbacks that place event dictionary objects on a
-    :class:`multiprocessing.Queue`. These events have a similar structure
+    Printer callbacks that send event dictionary objects down a
+    :class:`multiprocessing.Connection`. These events have a similar structure
     to that defined by
     `JSON-RPC 2.0 <http://www.jsonrpc.org/specification>`_ . E.g.
 
@@ -188,21 +188,34 @@ class QueuedPrinterCallbacks(PrinterCallbacks):
     This allows them to be easily converted into JSON-RPC 2.0 messages ready
     to be forwarded to a websocket-based event listener.
 
-    :param from_printer: A queue upon which to place callback messages.
-    :type from_printer: :class:`multiprocessing.Queue`
+    .. note::
+
+        Events are sent down the connection as plain dictionaries - the
+        connection pickles them in transit. They are deliberately *not*
+        JSON-encoded here; serialization to JSON happens once, server-side,
+        when an event is broadcast to websocket clients.
+
+    :param from_printer: Writable end of a pipe down which to send callback
+        messages.
+    :type from_printer: :class:`multiprocessing.Connection`
     """
 
     def __init__(self, from_printer):
         self._from_printer = from_printer
+        # Connection.send is not thread-safe and the printer may fire
+        # callbacks from multiple threads (e.g. the Marlin reader and writer
+        # threads).
+        self._lock = multiprocessing.Lock()
 
     def _publish(self, event):
         """
-        Publish an event from the printer to the `_from_printer` queue.
+        Publish an event from the printer to the `_from_printer` connection.
 
-        :param event: Event to be placed on the queue.
+        :param event: Event to be sent down the connection.
         :type event: :class:`dict`
         """
-        self._from_printer.put(event)
+        with self._lock:
+            self._from_printer.send(event)
 
     def log(self, level, message):
         self._publish({
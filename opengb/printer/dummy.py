@@ -2,6 +2,7 @@ import time
 import random
 import logging
 import json
+import queue
 
 from opengb.printer import IPrinter
 from opengb.printer import State
@@ -194,9 +195,15 @@ class Dummy(IPrinter):
             # Ensure connected
             if self._state == State.DISCONNECTED:
                 self._update_state(State.READY)
-            # Process a message from the to_printer queue.
-            if not self._to_printer.empty():
-                message = self._to_printer.get()
+            # Process a message from the to_printer queue. get_nowait avoids
+            # the empty()-then-get() pattern, which is both racy (empty() is
+            # approximate on a multiprocessing.Queue) and an extra lock
+            # acquisition per loop iteration.
+            try:
+                message = self._to_printer.get_nowait()
+            except queue.Empty:
+                message = None
+            if message is not None:
                 try:
                     if 'method' and 'params' in message.keys():
                         getattr(self, message['method'])(**message['params'])
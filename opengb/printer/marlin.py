@@ -637,9 +637,15 @@ class Marlin(IPrinter):
                 metric_interval > self._temp_poll_ready_sec):
                 self._request_printer_temperature()
                 self._temp_update_time = time.time()
-            # Process a message from the to_printer queue.
-            if not self._to_printer.empty():
-                message = self._to_printer.get()
+            # Process a message from the to_printer queue. get_nowait avoids
+            # the empty()-then-get() pattern, which is both racy (empty() is
+            # approximate on a multiprocessing.Queue) and an extra lock
+            # acquisition per loop iteration.
+            try:
+                message = self._to_printer.get_nowait()
+            except queue.Empty:
+                message = None
+            if message is not None:
                 try:
                     self._process_message_to_printer(message)
                 except KeyError as err:
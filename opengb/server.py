@@ -8,18 +8,40 @@ process and communicates with it via queues.
 import os
 import sys
 import json
+import threading
 import multiprocessing
+import concurrent.futures
 import datetime
 from pkg_resources import Requirement, resource_filename
 
+import tornado.gen
 import tornado.httpserver
 import tornado.ioloop
+import tornado.iostream
 import tornado.log
 import tornado.websocket
 from tornado.options import options
-from tornado.web import Application, RequestHandler, StaticFileHandler
+from tornado.web import Application, HTTPError, RequestHandler, \
+    StaticFileHandler
 from jsonrpc import JSONRPCResponseManager, Dispatcher
 
+# Tornado's C extension performs websocket frame masking orders of magnitude
+# faster than its pure-Python fallback. Its absence means Tornado was
+# installed without a C compiler available.
+try:
+    import tornado.speedups
+    TORNADO_SPEEDUPS = True
+except ImportError:
+    TORNADO_SPEEDUPS = False
+
+# orjson serializes several times faster than the stdlib json module. Every
+# websocket message and broadcast passes through JSON, so use it on those
+# paths when available.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 import opengb.config
 import opengb.printer
 import opengb.database as OGD
@@ -29,7 +51,101 @@ import opengb.utils as OGU
 LOGGER = tornado.log.app_log
 
 # Websocket clients.
-CLIENTS = []
+CLIENTS = set()
+
+# Maximum number of printer events processed per IOLoop callback. Bounds the
+# time spent in a single callback so the IOLoop remains responsive.
+EVENT_BATCH_MAX = 128
+
+# Maximum bytes of unflushed data buffered per websocket client. A client
+# which can't keep up with the broadcast rate is disconnected when its buffer
+# fills, rather than being allowed to grow server memory without bound.
+CLIENT_WRITE_BUFFER_MAX = 1024 * 1024
+
+# Snapshot-style events for which only the most recent value matters. When a
+# batch contains several of the same type, only the last is broadcast.
+COALESCED_EVENTS = ('temp_update', 'position_update', 'progress_update')
+
+# Executor on which blocking work (gcode file I/O, database access) runs so
+# that it never stalls the IOLoop. A single worker preserves the order in
+# which messages are dispatched.
+EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+# Cached result of MessageHandler.get_gcode_files, invalidated when a gcode
+# file is uploaded or deleted. Guarded by a lock as handlers may run on
+# EXECUTOR threads.
+_GCODE_FILES_CACHE = None
+_GCODE_FILES_CACHE_LOCK = threading.Lock()
+
+# Pre-serialized state_change message sent to newly-connected clients.
+# Refreshed only when the printer state actually changes, so connecting does
+# not re-encode a message whose content rarely varies.
+_STATE_MESSAGE = None
+
+
+def json_dumps(obj):
+    """
+    Serialize `obj` to a JSON string using the fastest available encoder.
+
+    .. note::
+
+        orjson serializes enums by value whereas the stdlib fallback uses
+        :class:`opengb.printer.StateEncoder` to serialize them by name, so
+        callers convert :class:`opengb.printer.State` members to their names
+        before serializing (as the websocket message format requires anyway).
+
+    :param obj: Object to serialize.
+    :returns: `obj` serialized as JSON.
+    :rtype: :class:`str`
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(obj, cls=opengb.printer.StateEncoder)
+
+
+def json_loads(data):
+    """
+    Deserialize JSON `data` using the fastest available decoder.
+
+    :param data: JSON to deserialize.
+    :type data: :class:`str`
+    :returns: The deserialized object.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _current_state_message():
+    """
+    Return the pre-serialized message describing current printer state.
+
+    Built lazily if no state change has been broadcast yet.
+
+    :returns: Serialized JSON-RPC state_change message.
+    :rtype: :class:`str`
+    """
+    global _STATE_MESSAGE
+    if _STATE_MESSAGE is None:
+        state = PRINTER['state'].name
+        _STATE_MESSAGE = json_dumps({
+            'jsonrpc':  '2.0',
+            'event':    'state_change',
+            'params': {
+                'old':      state,
+                'new':      state,
+            }
+        })
+    return _STATE_MESSAGE
+
+
+def _invalidate_gcode_files_cache():
+    """
+    Discard the cached gcode file list so it is rebuilt on next request.
+    """
+    global _GCODE_FILES_CACHE
+    with _GCODE_FILES_CACHE_LOCK:
+        _GCODE_FILES_CACHE = None
 
 # Local cache of printer state.
 PRINTER = {
@@ -423,13 +539,16 @@ class MessageHandler(object):
             thumbnail_png_base64 = thumbnail_png_base64,
         )
         destination = os.path.join(options.gcode_dir, str(gcode_file.id))
-        with open(destination, "wb") as gcode_file_out:
+        # The payload is written in a single call so an unbuffered file
+        # avoids copying it through a userspace buffer first.
+        with open(destination, "wb", buffering=0) as gcode_file_out:
             try:
                 gcode_file_out.write(payload_bytes)
             except IOError as e:
                 LOGGER.error('Error writing gcode file {0}: '
                              '{1}'.format(destination, e))
                 raise IOError('Unable to save gcode file.')
+        _invalidate_gcode_files_cache()
         return {
             'id': gcode_file.id,
             'name': name,
@@ -450,6 +569,10 @@ class MessageHandler(object):
 
         Optionally include the gcode file content.
 
+        The returned `download_url` streams the file content with constant
+        memory use and should be preferred over `content=True` for large
+        files, which embeds the entire file in the JSON response.
+
         :param id: ID of the gcode file to get.
         :type id: :class:`int`
         :param content: Include the gcode file content in the results.
@@ -459,6 +582,7 @@ class MessageHandler(object):
             result = OGD.GCodeFile.get(OGD.GCodeFile.id == id)
             gcode_file = {
                 'id':   result.id,
+                'download_url': '/gcode/{0}'.format(result.id),
                 'name': result.name,
                 'size': result.size,
                 'uploaded': str(result.uploaded),
@@ -485,6 +609,20 @@ class MessageHandler(object):
     def get_gcode_files(self):
         """
         Get details of all gcode files.
+
+        Results are cached until a gcode file is uploaded or deleted, so
+        polling this method does not hit the database on every call.
+        """
+        global _GCODE_FILES_CACHE
+        with _GCODE_FILES_CACHE_LOCK:
+            if _GCODE_FILES_CACHE is None:
+                _GCODE_FILES_CACHE = self._list_gcode_files()
+            return _GCODE_FILES_CACHE
+
+    @staticmethod
+    def _list_gcode_files():
+        """
+        Build details of all gcode files from the database.
         """
         return {'gcode_files': [
             {
@@ -516,6 +654,7 @@ class MessageHandler(object):
                          '{1}'.format(id, err))
             raise IndexError('Error deleting gcode file with '
                              'id {0}'.format(id)) from None
+        _invalidate_gcode_files_cache()
         return True
 
     def print_gcode_file(self, id):
@@ -589,37 +728,126 @@ class WebSocketHandler(tornado.websocket.WebSocketHandler):
     to methods and generate valid JSON-RPC 2.0 responses.
     """
 
+    # Frequently-called methods which simply enqueue a printer message.
+    # These are dispatched directly in on_message, bypassing the full
+    # JSON-RPC validation and response machinery.
+    FAST_METHODS = ('set_temp', 'move_head_relative', 'move_head_absolute',
+                    'home_head')
+
     def __init__(self, *args, **kwargs):
-        message_handler = MessageHandler(kwargs.pop('to_printer'))
-        self.dispatcher = Dispatcher(message_handler)
+        self.dispatcher = kwargs.pop('dispatcher')
+        self._fast_methods = {method: self.dispatcher[method]
+                              for method in self.FAST_METHODS}
         super().__init__(*args, **kwargs)
 
     def check_origin(self, origin):
         return True
 
+    def get_compression_options(self):
+        # Offer permessage-deflate to clients. Printer events are small JSON
+        # with highly repetitive keys, so even the lowest compression level
+        # shrinks them to a fraction of their size on the wire.
+        return {'compression_level': 1, 'mem_level': 8}
+
     def open(self):
         LOGGER.info('New connection from {0}'.format(self.request.remote_ip))
-        CLIENTS.append(self)
+        self.ws_connection.stream.max_write_buffer_size = \
+            CLIENT_WRITE_BUFFER_MAX
+        CLIENTS.add(self)
+        # Send current printer state so the client doesn't have to wait for
+        # the next state change event.
+        self.write_message(_current_state_message())
 
     def on_close(self):
         LOGGER.info('Connection closed to {0}'.format(self.request.remote_ip))
-        CLIENTS.remove(self)
+        CLIENTS.discard(self)
 
+    @tornado.gen.coroutine
     def on_message(self, message):
         """
         Passes an incoming JSON-RPC message to the dispatcher for processing.
+
+        Calls to methods in :data:`FAST_METHODS` are dispatched directly:
+        they only place a message on the printer queue, so the JSON-RPC
+        library's per-message validation and response construction is
+        skipped. Everything else runs on :data:`EXECUTOR` so that methods
+        which block on disk or database access (e.g. a multi-megabyte gcode
+        upload) do not stall the IOLoop for every other client.
         """
         LOGGER.debug('Message received from {0}: {1}'.format(
             self.request.remote_ip, message[:75]))
-        response = JSONRPCResponseManager.handle(message, self.dispatcher)
+        try:
+            request = json_loads(message)
+            fast_method = self._fast_methods.get(request.get('method'))
+        except (ValueError, AttributeError):
+            request = None
+            fast_method = None
+        if fast_method is not None and 'id' in request:
+            try:
+                result = fast_method(**request.get('params', {}))
+            except TypeError:
+                # Argument binding failed, meaning no message reached the
+                # printer queue. Fall through to the full manager which will
+                # produce a proper JSON-RPC error response. Nothing else may
+                # fall through: once the method has run, re-dispatching it
+                # would queue the printer command twice.
+                pass
+            else:
+                self.write_message(json_dumps({
+                    'jsonrpc':  '2.0',
+                    'id':       request['id'],
+                    'result':   result,
+                }))
+                return
+        response = yield EXECUTOR.submit(
+            JSONRPCResponseManager.handle, message, self.dispatcher)
         LOGGER.debug('Sending response to {0}: {1}'.format(
             self.request.remote_ip, str(response._data)[:75]))
         self.write_message(response.json)
 
 
+class GcodeDownloadHandler(RequestHandler):
+    """
+    Streams the content of the gcode file with the given id.
+
+    Unlike the JSON-RPC `get_gcode_file` method with `content=True`, which
+    loads the entire file into memory and embeds it in a JSON response, this
+    handler streams the file in chunks so memory use is constant regardless
+    of file size.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    @tornado.gen.coroutine
+    def get(self, id):
+        try:
+            OGD.GCodeFile.get(OGD.GCodeFile.id == id)
+        except OGD.GCodeFile.DoesNotExist:
+            raise HTTPError(404, 'No gcode file found with id {0}'.format(id))
+        destination = os.path.join(options.gcode_dir, str(id))
+        try:
+            gcode_file_in = open(destination, 'rb')
+        except IOError as err:
+            LOGGER.error('Error reading gcode file with id {0}: '
+                         '{1}'.format(id, err))
+            raise HTTPError(500, 'Error reading gcode file with '
+                                 'id {0}'.format(id))
+        self.set_header('Content-Type', 'text/plain')
+        with gcode_file_in:
+            while True:
+                chunk = gcode_file_in.read(self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.write(chunk)
+                yield self.flush()
+
+
 class StatusHandler(RequestHandler):
     def get(self):
-        self.write(json.dumps(PRINTER, cls=opengb.printer.StateEncoder))
+        # Enums don't serialise so replace with name.
+        printer = PRINTER.copy()
+        printer['state'] = printer['state'].name
+        self.write(json_dumps(printer))
         self.set_header("Content-Type", "application/json")
 
 
@@ -627,11 +855,37 @@ def broadcast_message(message):
     """
     Broadcast message to websocket clients.
 
-    Adds 'jsonrpc' field required to satisfy the JSON-RPC 2.0 spec.
+    The message is serialized once and the same payload is written to every
+    client, rather than having Tornado re-serialize it per client.
+
+    :param message: Message to broadcast. A :class:`dict` will have the
+        'jsonrpc' field required by the JSON-RPC 2.0 spec added before being
+        serialized. A :class:`str` is assumed to be a pre-serialized JSON-RPC
+        message and is sent as-is.
     """
-    message['jsonrpc'] = '2.0'
-    for each in CLIENTS:
-        each.write_message(message)
+    if isinstance(message, dict):
+        message['jsonrpc'] = '2.0'
+        payload = json_dumps(message)
+    else:
+        payload = message
+    for each in list(CLIENTS):
+        try:
+            each.write_message(payload)
+        except tornado.iostream.StreamBufferFullError:
+            LOGGER.warning('Disconnecting slow consumer '
+                           '{0}'.format(each.request.remote_ip))
+            CLIENTS.discard(each)
+            try:
+                each.close(1013, 'slow consumer')
+            except tornado.iostream.StreamBufferFullError:
+                # No room left for even a close frame; drop the underlying
+                # stream so the rest of the batch still goes out.
+                each.ws_connection.stream.close()
+        except (tornado.websocket.WebSocketClosedError,
+                tornado.iostream.StreamClosedError):
+            LOGGER.info('Evicting closed connection to '
+                        '{0}'.format(each.request.remote_ip))
+            CLIENTS.discard(each)
 
 
 def process_event(event):
@@ -639,10 +893,14 @@ def process_event(event):
     Process an event from the printer.
     """
     global PRINTER
+    global _STATE_MESSAGE
     try:
         if event['event'] == 'state_change':
             # TODO: if state changes from printing to ready, reset progress.
             PRINTER['state'] = opengb.printer.State[event['params']['new']]
+            # Cache the serialized event (state changes are rare) so each
+            # newly-connecting client receives it without a fresh encode.
+            _STATE_MESSAGE = json_dumps(event)
         elif event['event'] == 'extrude_override_change':
             PRINTER['extrude_override'] = event['params']
         elif event['event'] == 'speed_override_change':
@@ -664,33 +922,98 @@ def process_event(event):
         LOGGER.error('Malformed event from printer: {0}'.format(event))
 
 
-def process_printer_events(from_printer):
+def process_printer_events(events):
     """
-    Process events from printer.
+    Process a batch of events from the printer.
 
-    Runs via a :class:`tornado.ioloop.PeriodicCallback`.
+    Runs on the IOLoop, scheduled by :func:`read_printer_events`. Log events
+    are passed to the logger. Snapshot events (:data:`COALESCED_EVENTS`) are
+    collapsed last-value-wins, since a burst of temperature or progress
+    updates carries no more information than its final value. Everything
+    else is broadcast in arrival order, followed by the coalesced snapshots.
 
-    :param from_printer: A queue which will be populated with messages sent
-        from the printer.
-    :type from_printer: :class:`multiuprocessing.Queue`
+    :param events: Events sent from the printer.
+    :type events: :class:`list` of :class:`dict`
     """
-    if not from_printer.empty():
+    ordered = []
+    latest = {}
+    for event in events:
         try:
-            event = from_printer.get()
             if event['event'] == 'log':
                 LOGGER.log(event['params']['level'], event['params']['msg'])
+            elif event['event'] in COALESCED_EVENTS:
+                latest[event['event']] = event
             else:
-                broadcast_message(event)
-                process_event(event)
+                ordered.append(event)
         except TypeError as e:
             LOGGER.exception(e)
+    for event in ordered + list(latest.values()):
+        try:
+            broadcast_message(event)
+            process_event(event)
+        except TypeError as e:
+            LOGGER.exception(e)
+
+
+def read_printer_events(from_printer, main_loop):
+    """
+    Read events from the printer and schedule them for processing on the
+    IOLoop.
+
+    Blocks on the `from_printer` connection so no CPU is consumed while the
+    printer is quiet, then drains any further pending events (up to
+    :data:`EVENT_BATCH_MAX`) so that bursts are handled in a single IOLoop
+    callback. Runs as a daemon thread. A sentinel value of `None` sent down
+    the connection (or the printer end closing) stops the thread.
+
+    :param from_printer: Readable end of a pipe which will be populated with
+        messages sent from the printer.
+    :type from_printer: :class:`multiprocessing.Connection`
+    :param main_loop: IOLoop on which events will be processed.
+    :type main_loop: :class:`tornado.ioloop.IOLoop`
+    """
+    while True:
+        try:
+            event = from_printer.recv()
+        except EOFError:
+            break
+        if event is None:
+            break
+        events = [event]
+        while len(events) < EVENT_BATCH_MAX and from_printer.poll():
+            try:
+                event = from_printer.recv()
+            except EOFError:
+                break
+            if event is None:
+                main_loop.add_callback(process_printer_events, events)
+                return
+            events.append(event)
+        main_loop.add_callback(process_printer_events, events)
+
+
+def _log_background_exception(future):
+    """
+    Log any exception raised by a task submitted to :data:`EXECUTOR`.
+
+    Attached as a done-callback to futures which are otherwise discarded,
+    since an unobserved future swallows its exception silently.
+
+    :param future: Completed future to check for an exception.
+    :type future: :class:`concurrent.futures.Future`
+    """
+    error = future.exception()
+    if error is not None:
+        LOGGER.error('Error in background task: {0}'.format(error))
 
 
 def update_counters(count=1):
     """
     Increment all printer counters.
 
-    Runs via a :class:`tornado.ioloop.PeriodicCallback`.
+    Scheduled via a :class:`tornado.ioloop.PeriodicCallback` but runs on
+    :data:`EXECUTOR` so the sqlite write (and its fsync) never stalls the
+    IOLoop.
 
     :param count: Value by which to increment counters.
     :type count: :class:`int`
@@ -701,6 +1024,28 @@ def update_counters(count=1):
     query.execute()
 
 
+def set_cpu_affinity(printer_pid):
+    """
+    Pin the server and printer processes to separate CPU cores.
+
+    The two processes exchange messages constantly; letting the scheduler
+    bounce them across cores invalidates each other's caches on every
+    exchange. Pinning keeps producer and consumer resident. Skipped on
+    single-core machines and on platforms without `sched_setaffinity`.
+
+    :param printer_pid: PID of the printer process.
+    :type printer_pid: :class:`int`
+    """
+    # cpu_count() may return None if the count is undeterminable.
+    if not hasattr(os, 'sched_setaffinity') or (os.cpu_count() or 1) < 2:
+        return
+    try:
+        os.sched_setaffinity(0, {0})
+        os.sched_setaffinity(printer_pid, {1})
+    except OSError as err:
+        LOGGER.warning('Unable to set CPU affinity: {0}'.format(err))
+
+
 def get_frontend_handlers(frontend_name):
     """
     Return handlers for frontend with the given name.
@@ -737,15 +1082,40 @@ def main():
     # Load config.
     options.parse_config_file(opengb.config.CONFIG_FILE)
 
+    # Warn loudly if the websocket hot path will run on the slow Python
+    # masker rather than in C.
+    if not TORNADO_SPEEDUPS:
+        LOGGER.warning('tornado.speedups C extension not available - '
+                       'websocket performance will be degraded. Reinstall '
+                       'Tornado with a C compiler available, e.g. '
+                       '"pip install --no-binary tornado tornado".')
+
+    # Run Tornado on top of uvloop if it is available. uvloop's libuv-based
+    # event loop roughly doubles socket throughput, which matters when
+    # printer events fan out to many websocket clients. Must happen before
+    # any IOLoop is created.
+    try:
+        import asyncio
+        import uvloop
+        from tornado.platform.asyncio import AsyncIOMainLoop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        AsyncIOMainLoop().install()
+        LOGGER.info('Using uvloop event loop.')
+    except ImportError:
+        LOGGER.debug('uvloop not available - using the default IOLoop.')
+
     # Initialize database.
     OGD.initialize(options.db_file)
 
-    # Initialize printer queues.
+    # Initialize printer channels. Commands to the printer travel on a queue;
+    # the high-rate event stream from the printer travels on a pipe, which
+    # avoids the queue's feeder thread and lock on the hot path.
     to_printer = multiprocessing.Queue()
-    from_printer = multiprocessing.Queue()
+    from_printer, from_printer_writer = multiprocessing.Pipe(duplex=False)
 
     # Initialize printer using queue callbacks.
-    printer_callbacks = opengb.printer.QueuedPrinterCallbacks(from_printer)
+    printer_callbacks = opengb.printer.QueuedPrinterCallbacks(
+        from_printer_writer)
     printer_type = getattr(opengb.printer, options.printer)
     printer = printer_type(to_printer, printer_callbacks,
                            baud_rate=options.baud_rate,
@@ -753,10 +1123,17 @@ def main():
                            lcd_gpio_pin=options.lcd_gpio_pin)
     printer.daemon = True
     printer.start()
+    set_cpu_affinity(printer.pid)
 
     # Initialize web server.
-    # Backend handler is always required.
-    handlers = [(r"/ws", WebSocketHandler, {"to_printer": to_printer})]
+    # A single message handler and dispatcher are shared by every websocket
+    # connection - the handler methods hold no per-connection state.
+    dispatcher = Dispatcher(MessageHandler(to_printer))
+    # Backend handlers are always required.
+    handlers = [
+        (r"/ws", WebSocketHandler, {"dispatcher": dispatcher}),
+        (r"/gcode/(\d+)", GcodeDownloadHandler),
+    ]
     # Frontend-specfic handlers added if required.
     try:
         handlers += get_frontend_handlers(options.frontend)
@@ -769,15 +1146,20 @@ def main():
 
     # Create event loop and periodic callbacks
     main_loop = tornado.ioloop.IOLoop.instance()
-    printer_event_processor = tornado.ioloop.PeriodicCallback(
-        lambda: process_printer_events(from_printer), 10, io_loop=main_loop)
     counter_updater = tornado.ioloop.PeriodicCallback(
-        lambda: update_counters(), 60000)
+        lambda: EXECUTOR.submit(update_counters).add_done_callback(
+            _log_background_exception), 60000)
     # TODO: ioloop for watchdog
     # TODO: ioloop for camera
 
+    # Read printer events on a dedicated thread which blocks on the
+    # from_printer queue and hands each event to the IOLoop.
+    printer_event_reader = threading.Thread(
+        target=read_printer_events, args=(from_printer, main_loop),
+        daemon=True)
+
     # Rock and roll.
-    printer_event_processor.start()
+    printer_event_reader.start()
     counter_updater.start()
     main_loop.start()
 
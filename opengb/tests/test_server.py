@@ -14,11 +14,15 @@ TODO:
 import os
 from multiprocessing import Queue
 import json
+import queue
 import tempfile
 import shutil
-from unittest.mock import patch
+from unittest.mock import patch, Mock
 from datetime import datetime
 
+import tornado.ioloop
+import tornado.websocket
+
 from peewee import SqliteDatabase
 from playhouse.test_utils import test_database
 
@@ -350,6 +354,9 @@ class TestGetGCodeFiles(OpengbTestCase):
         self.message_handler = server.MessageHandler(
             to_printer=self.to_printer)
         self.uploaded = datetime.now()
+        # The gcode file list cache is process-global; reset it so results
+        # from other tests are not served here.
+        server._invalidate_gcode_files_cache()
 
     def test_all_gcode_files_returned(self):
         """All gcode files are returned."""
@@ -417,6 +424,51 @@ class TestGetGCodeFiles(OpengbTestCase):
         ])
 
 
+    def test_gcode_files_cached_between_calls(self):
+        """A second call returns the cached list without querying again."""
+        with test_database(self.db, [GCodeFile], create_tables=True):
+            GCodeFile.create(name='test_file_1', size=777,
+                             uploaded=self.uploaded, print_material='PLA',
+                             print_quality='High', print_extruders='Both',
+                             print_time_sec=56743, print_filament_mm=9876,
+                             print_material_gm=40,
+                             thumbnail_png_base64='xyz123')
+            first = self.message_handler.get_gcode_files()
+            with patch.object(server.MessageHandler,
+                              '_list_gcode_files') as m_list:
+                second = self.message_handler.get_gcode_files()
+        m_list.assert_not_called()
+        self.assertIs(first, second)
+
+    def test_put_gcode_file_invalidates_cache(self):
+        """Uploading a gcode file invalidates the cached list."""
+        with test_database(self.db, [GCodeFile], create_tables=True):
+            self.assertEqual(
+                self.message_handler.get_gcode_files()['gcode_files'], [])
+            gcode_dir = tempfile.mkdtemp()
+            with patch.object(server.options.mockable(), 'gcode_dir',
+                              gcode_dir):
+                self.message_handler.put_gcode_file(GCODE, 'test_name')
+            r = self.message_handler.get_gcode_files()
+        shutil.rmtree(gcode_dir)
+        self.assertEqual(len(r['gcode_files']), 1)
+        self.assertEqual(r['gcode_files'][0]['name'], 'test_name')
+
+    def test_delete_gcode_file_invalidates_cache(self):
+        """Deleting a gcode file invalidates the cached list."""
+        with test_database(self.db, [GCodeFile], create_tables=True):
+            GCodeFile.create(name='test_file_1', size=777,
+                             uploaded=self.uploaded, print_material='PLA',
+                             print_quality='High', print_extruders='Both',
+                             print_time_sec=56743, print_filament_mm=9876,
+                             print_material_gm=40,
+                             thumbnail_png_base64='xyz123')
+            self.message_handler.get_gcode_files()
+            with patch('opengb.utils.delete_gcode_file'):
+                self.message_handler.delete_gcode_file(1)
+        self.assertIsNone(server._GCODE_FILES_CACHE)
+
+
 class TestDeleteGCodeFile(OpengbTestCase):
 
     def setUp(self):
@@ -435,6 +487,109 @@ class TestDeleteGCodeFile(OpengbTestCase):
         pass
 
 
+class TestFastDispatch(OpengbTestCase):
+
+    def setUp(self):
+        self.to_printer = Queue()
+        self.dispatcher = server.Dispatcher(
+            server.MessageHandler(to_printer=self.to_printer))
+        # Build a handler without the websocket plumbing - on_message only
+        # needs the dispatcher, the fast method table and a request to log.
+        self.handler = server.WebSocketHandler.__new__(server.WebSocketHandler)
+        self.handler.dispatcher = self.dispatcher
+        self.handler._fast_methods = {
+            method: self.dispatcher[method]
+            for method in server.WebSocketHandler.FAST_METHODS}
+        self.handler.request = Mock(remote_ip='127.0.0.1')
+        self.written = []
+        self.handler.write_message = self.written.append
+        self.io_loop = tornado.ioloop.IOLoop()
+
+    def tearDown(self):
+        self.io_loop.close()
+
+    def _on_message(self, message):
+        self.io_loop.run_sync(lambda: self.handler.on_message(message))
+
+    def test_fast_method_result_written(self):
+        """A fast-dispatched method writes a JSON-RPC result response."""
+        self._on_message(json.dumps({
+            'jsonrpc': '2.0', 'id': 7, 'method': 'set_temp',
+            'params': {'bed': 100}}))
+        self.assertEqual(json.loads(self.written[0]),
+                         {'jsonrpc': '2.0', 'id': 7, 'result': True})
+        self.assertEqual(self.to_printer.get(timeout=2)['method'], 'set_temp')
+
+    def test_closed_client_does_not_requeue_command(self):
+        """A write failure after fast dispatch does not re-queue the
+        command."""
+        self.handler.write_message = Mock(
+            side_effect=tornado.websocket.WebSocketClosedError())
+        with self.assertRaises(tornado.websocket.WebSocketClosedError):
+            self._on_message(json.dumps({
+                'jsonrpc': '2.0', 'id': 1, 'method': 'move_head_relative',
+                'params': {'z': 10}}))
+        self.assertEqual(self.to_printer.get(timeout=2)['method'],
+                         'move_head_relative')
+        with self.assertRaises(queue.Empty):
+            self.to_printer.get(timeout=0.2)
+
+    def test_bad_params_fall_through_without_queueing(self):
+        """Unbindable params produce a JSON-RPC error and queue nothing."""
+        self._on_message(json.dumps({
+            'jsonrpc': '2.0', 'id': 2, 'method': 'home_head',
+            'params': {'bogus': True}}))
+        self.assertIn('error', json.loads(self.written[0]))
+        with self.assertRaises(queue.Empty):
+            self.to_printer.get(timeout=0.2)
+
+    def test_unknown_method_dispatched_by_manager(self):
+        """Methods outside the fast table still get a JSON-RPC response."""
+        self._on_message(json.dumps({
+            'jsonrpc': '2.0', 'id': 3, 'method': 'enable_steppers',
+            'params': {}}))
+        self.assertEqual(json.loads(self.written[0])['result'], True)
+        self.assertEqual(self.to_printer.get(timeout=2)['method'],
+                         'enable_steppers')
+
+
+class TestProcessPrinterEvents(OpengbTestCase):
+
+    def test_snapshot_events_coalesced_last_value_wins(self):
+        """Only the last of several snapshot events of a type is broadcast."""
+        events = [
+            {'event': 'temp_update', 'params': {'bed_current': 1}},
+            {'event': 'temp_update', 'params': {'bed_current': 2}},
+            {'event': 'temp_update', 'params': {'bed_current': 3}},
+        ]
+        with patch.object(server, 'broadcast_message') as m_broadcast, \
+                patch.object(server, 'process_event'):
+            server.process_printer_events(events)
+        m_broadcast.assert_called_once_with(events[2])
+
+    def test_discrete_events_broadcast_in_order(self):
+        """Non-snapshot events are broadcast in arrival order."""
+        events = [
+            {'event': 'state_change',
+             'params': {'old': 'READY', 'new': 'EXECUTING'}},
+            {'event': 'steppers_update', 'params': {'enabled': True}},
+        ]
+        with patch.object(server, 'broadcast_message') as m_broadcast, \
+                patch.object(server, 'process_event'):
+            server.process_printer_events(events)
+        self.assertEqual([c[0][0] for c in m_broadcast.call_args_list],
+                         events)
+
+    def test_log_events_logged_not_broadcast(self):
+        """Log events go to the logger and are not broadcast."""
+        events = [{'event': 'log', 'params': {'level': 20, 'msg': 'test'}}]
+        with patch.object(server, 'broadcast_message') as m_broadcast, \
+                patch.object(server.LOGGER, 'log') as m_log:
+            server.process_printer_events(events)
+        m_log.assert_called_once_with(20, 'test')
+        m_broadcast.assert_not_called()
+
+
 class TestGetCounters(OpengbTestCase):
 
     def setUp(self):
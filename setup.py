@@ -24,6 +24,12 @@ setup(
         'psutil>=4.1,<5',
         'RPi.GPIO>=0.6.2,<0.7',
     ],
+    extras_require={
+        'speedups': [
+            'orjson',
+            'uvloop',
+        ],
+    },
     tests_require=[
     ],
     classifiers=[